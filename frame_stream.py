@@ -0,0 +1,317 @@
+# -*-: coding utf-8 -*-
+""" Streaming of LED frames to remote satellites over MQTT. """
+
+import struct
+import threading
+import time
+
+MQTT_TOPIC_FRAMES = "ledhandler/{}/frames"
+
+
+class Frame:
+    """ A snapshot of the ReSpeaker LED registers.
+
+    On the wire, a frame is a header (version, flags, sequence number)
+    followed by (address, length, data) entries. A keyframe holds every
+    register, a delta frame only those that changed since the previous
+    frame.
+    """
+
+    VERSION = 1
+    KEYFRAME = 0x01
+
+    HEADER = struct.Struct('<BBH')
+    ENTRY = struct.Struct('<BB')
+
+    def __init__(self, seq, keyframe, registers):
+        self.seq = seq
+        self.keyframe = keyframe
+        self.registers = registers
+
+    def encode(self):
+        flags = Frame.KEYFRAME if self.keyframe else 0
+        payload = bytearray(Frame.HEADER.pack(Frame.VERSION, flags, self.seq))
+        for address in sorted(self.registers):
+            data = self.registers[address]
+            payload += Frame.ENTRY.pack(address, len(data)) + data
+        return bytes(payload)
+
+    @staticmethod
+    def decode(payload):
+        payload = bytes(payload)
+        if len(payload) < Frame.HEADER.size:
+            raise ValueError("Frame too short ({} bytes)".format(len(payload)))
+
+        (version, flags, seq) = Frame.HEADER.unpack_from(payload)
+        if version != Frame.VERSION:
+            raise ValueError("Unsupported frame version {}".format(version))
+
+        registers = {}
+        offset = Frame.HEADER.size
+        while offset < len(payload):
+            if offset + Frame.ENTRY.size > len(payload):
+                raise ValueError("Truncated frame entry at offset {}".format(offset))
+            (address, length) = Frame.ENTRY.unpack_from(payload, offset)
+            offset = offset + Frame.ENTRY.size
+            if offset + length > len(payload):
+                raise ValueError("Truncated frame data at offset {}".format(offset))
+            registers[address] = payload[offset:offset + length]
+            offset = offset + length
+
+        return Frame(seq, bool(flags & Frame.KEYFRAME), registers)
+
+
+class FrameBuffer:
+    """ Stands in for the ReSpeaker HID device on the central ledhandler.
+        Instead of sending packets over USB, it keeps the last value written
+        to each register, so that a ReSpeakerAnimator can render into it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.registers = {}
+        self.force_keyframe = True
+
+    def write(self, packet):
+        """ Record a packet as built by ReSpeakerAnimator.write. """
+        address = packet[0] | (packet[1] << 8)
+        length = packet[2] | (packet[3] << 8)
+        data = bytes(bytearray(packet[4:4 + length]))
+
+        with self.lock:
+            if address == 0:
+                previous = self.registers.get(0)
+                if previous is None or previous[:1] != data[:1]:
+                    # Switching mode makes the per-led registers meaningless
+                    self.registers = {}
+                    self.force_keyframe = True
+            self.registers[address] = data
+            self.changed.set()
+
+    def read(self):
+        return None
+
+    def request_keyframe(self):
+        """ Have the next frame be a keyframe, even without any change. """
+        with self.lock:
+            self.force_keyframe = True
+            self.changed.set()
+
+    def take(self):
+        """ Return the current registers and whether a keyframe is needed,
+            and reset the change notification.
+        """
+        with self.lock:
+            self.changed.clear()
+            force_keyframe = self.force_keyframe
+            self.force_keyframe = False
+            return (dict(self.registers), force_keyframe)
+
+
+class FrameStreamer:
+    """ Publish the frames rendered into a FrameBuffer for one site.
+
+    Frames are only sent when the registers change, at a rate that follows
+    the broker round-trip time, measured on the PUBACK of keyframes (which
+    are sent with QoS 1 and retained so that late satellites catch up).
+    Once the registers stop changing for max_interval, a last keyframe is
+    sent, so that the retained frame always matches what the ring shows.
+    """
+
+    RTT_FACTOR = 4
+    RTT_SMOOTHING = 0.2
+
+    def __init__(self, site_id, frame_buffer, publish, logger=None,
+                 keyframe_interval=50, min_interval=0.025, max_interval=1.0):
+        """ Initialisation.
+
+        :param site_id: the site the frames are published for.
+        :param frame_buffer: the FrameBuffer the animator renders into.
+        :param publish: function (topic, payload, qos, retain) sending a
+                        message and returning its MQTT message id, or None
+                        if it could not be sent.
+        :param logger: optional logger.
+        :param keyframe_interval: number of frames between two keyframes.
+        :param min_interval: shortest time between two frames, in seconds.
+        :param max_interval: longest time between two frames, in seconds.
+        """
+        self.topic = MQTT_TOPIC_FRAMES.format(site_id)
+        self.frame_buffer = frame_buffer
+        self.publish = publish
+        self.logger = logger
+        self.keyframe_interval = keyframe_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.seq = 0
+        self.sent = None
+        self.frames_since_keyframe = 0
+        self.last_sent_at = 0
+        # Whether the last frame sent was a keyframe
+        self.settled = False
+        self.rtt = None
+        # The keyframe whose PUBACK is awaited, as (mid, sent_at). Acks
+        # received while its publish() call is still running are kept in
+        # early_acks, as the mid is not known yet.
+        self.rtt_lock = threading.Lock()
+        self.rtt_probe = None
+        self.probing = False
+        self.early_acks = {}
+
+    def interval(self):
+        """ Time to wait between two frames, given the measured round-trip. """
+        if self.rtt is None:
+            return self.min_interval
+        return min(self.max_interval, max(self.min_interval, self.rtt * FrameStreamer.RTT_FACTOR))
+
+    def on_publish(self, mid):
+        """ Callback when the broker acknowledged a message. """
+        acked_at = time.monotonic()
+        with self.rtt_lock:
+            if self.rtt_probe is not None and self.rtt_probe[0] == mid:
+                self.add_rtt_sample(acked_at - self.rtt_probe[1])
+                self.rtt_probe = None
+            elif self.probing:
+                self.early_acks[mid] = acked_at
+
+    def add_rtt_sample(self, sample):
+        if self.rtt is None:
+            self.rtt = sample
+        else:
+            self.rtt = (1 - FrameStreamer.RTT_SMOOTHING) * self.rtt + FrameStreamer.RTT_SMOOTHING * sample
+
+    def resync(self):
+        """ Send a keyframe of the current state, e.g. after reconnecting,
+            as frames published while disconnected were dropped.
+        """
+        self.frame_buffer.request_keyframe()
+
+    def stop(self):
+        """ Wake the streaming thread up so that it notices it must stop. """
+        self.frame_buffer.changed.set()
+
+    def run(self, run_event):
+        """ Stream frames until stopped. Once the settling keyframe is sent,
+            blocks without any timeout while the registers do not change.
+
+        :param run_event: a run event object provided by the thread handler.
+        """
+        while run_event.is_set():
+            if self.settled or self.sent is None:
+                self.frame_buffer.changed.wait()
+            elif not self.frame_buffer.changed.wait(self.max_interval):
+                self.send_frame(force_keyframe=True)
+                continue
+            if not run_event.is_set():
+                break
+
+            delay = self.last_sent_at + self.interval() - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            self.send_frame()
+
+    def send_frame(self, force_keyframe=False):
+        (registers, mode_changed) = self.frame_buffer.take()
+        if not registers:
+            # Nothing rendered yet, do not replace the retained frame
+            return
+
+        keyframe = force_keyframe or mode_changed or self.sent is None \
+            or self.frames_since_keyframe >= self.keyframe_interval
+        if keyframe:
+            changed = registers
+        else:
+            changed = {address: data for (address, data) in registers.items()
+                       if self.sent.get(address) != data}
+            if not changed:
+                return
+
+        self.seq = (self.seq + 1) & 0xFFFF
+        payload = Frame(self.seq, keyframe, changed).encode()
+        self.sent = registers
+        self.last_sent_at = time.monotonic()
+        self.settled = keyframe
+
+        if keyframe:
+            self.frames_since_keyframe = 0
+            with self.rtt_lock:
+                self.probing = True
+                self.early_acks = {}
+            sent_at = time.monotonic()
+            mid = self.publish(self.topic, payload, 1, True)
+            with self.rtt_lock:
+                self.probing = False
+                acked_at = self.early_acks.pop(mid, None)
+                self.early_acks = {}
+                if mid is None:
+                    # Not sent, there is no PUBACK to wait for
+                    self.rtt_probe = None
+                elif acked_at is not None:
+                    self.add_rtt_sample(acked_at - sent_at)
+                    self.rtt_probe = None
+                else:
+                    self.rtt_probe = (mid, sent_at)
+        else:
+            self.frames_since_keyframe = self.frames_since_keyframe + 1
+            self.publish(self.topic, payload, 0, False)
+
+
+class FrameReceiver:
+    """ Apply the frames streamed by a central ledhandler to the local
+        ReSpeaker, through its animator.
+    """
+
+    IDLE_AFTER = 10
+
+    def __init__(self, animator, logger=None, idle_after=None):
+        """ Initialisation.
+
+        :param animator: the ReSpeakerAnimator to apply the frames with.
+        :param logger: optional logger.
+        :param idle_after: seconds without any frame applied after which
+                           the ring is considered idle.
+        """
+        self.animator = animator
+        self.logger = logger
+        self.idle_after = idle_after or FrameReceiver.IDLE_AFTER
+        self.seq = None
+        self.last_applied_at = time.monotonic()
+
+    def is_idle(self):
+        return time.monotonic() - self.last_applied_at >= self.idle_after
+
+    def reset(self):
+        """ Ignore delta frames until the next keyframe. """
+        self.seq = None
+
+    def apply(self, payload):
+        """ Apply a frame payload. Delta frames received after a gap are
+            dropped until the next keyframe.
+
+        :param payload: the binary frame.
+        :return: True if the frame was applied.
+        """
+        try:
+            frame = Frame.decode(payload)
+        except (ValueError, struct.error) as e:
+            if self.logger is not None:
+                self.logger.error("Invalid frame: {}".format(e))
+            return False
+
+        if not frame.keyframe and (self.seq is None or frame.seq != (self.seq + 1) & 0xFFFF):
+            if self.logger is not None and self.seq is not None:
+                self.logger.debug("Missed frames, waiting for the next keyframe")
+            self.seq = None
+            return False
+
+        self.seq = frame.seq
+        if self.animator is None:
+            return False
+
+        self.last_applied_at = time.monotonic()
+
+        for address in sorted(frame.registers):
+            self.animator.write(address, list(bytearray(frame.registers[address])))
+        return True
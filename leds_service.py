@@ -11,7 +11,6 @@ from colour import Color
 
 from usb.core import USBError
 
-from singleton import Singleton
 from usb_utils import USB
 
 try:
@@ -27,13 +26,15 @@ class LedsService:
 
     class State:
         """ Leds states.- """
-        none, waking_up, standby, listening, loading, notify, error, intentParsed, speak = range(9)
+        none, waking_up, standby, listening, loading, notify, error, intentParsed, speak, idle = range(10)
 
-    def __init__(self, thread_handler, logger = None):
+    def __init__(self, thread_handler, logger = None, animator = None, detect_leds = True):
         self.thread_handler = thread_handler
-        led_device = USB.get_boards()
         self.logger = logger
-        if led_device == USB.Device.respeaker:
+        self.animation = Animation(None)
+        if animator is not None:
+            self.animator = animator
+        elif detect_leds and USB.get_boards() == USB.Device.respeaker:
             self.animator = ReSpeakerAnimator(logger = logger)
         else:
             self.animator = None
@@ -46,12 +47,29 @@ class LedsService:
         self.thread_handler.run(target=self.animator.run,
                                 args=(identifier, animation, ))
 
+    def idle(self, rgb=0):
+        """ Dim or blank the ring with a single firmware command, without
+            spawning an animation thread.
+
+        :param rgb: the colour to dim to, 0 to switch the leds off.
+        """
+        if not self.animator:
+            return
+        # Invalidate any running animation loop before taking over the ring
+        self.animation.id = None
+        self.animation.active = LedsService.State.idle
+        self.animator.set_color(rgb=rgb)
+
     def get_animation(self, animation):
+        # The same Animation is shared by every animation started by this
+        # service, so that a running loop stops as soon as its id changes.
         identifier = str(random.randint(1, 100000))
-        return (Animation(identifier, animation), identifier)
+        self.animation.id = identifier
+        self.animation.active = animation
+        return (self.animation, identifier)
 
 
-class Animation(Singleton):
+class Animation(object):
 
     def __init__(self, id, active=0):
         self.id = id
@@ -60,9 +78,9 @@ class Animation(Singleton):
 
 class ReSpeakerAnimator(object):
 
-    def __init__(self, logger = None):
+    def __init__(self, logger = None, hid = None):
         self.logger = logger
-        self.hid = usb_hid.get()
+        self.hid = hid if hid is not None else usb_hid.get()
         self.led_dict = {
             'LED_1': 3,
             'LED_2': 4,
@@ -211,8 +229,13 @@ class ReSpeakerAnimator(object):
             if not self.logger is None:
                 self.logger.debug("Launching animation : Standby")
             time.sleep(2)
+            # Another animation, or idle, may have taken over meanwhile
+            if animation.id != id:
+                return
             self.off()
             time.sleep(0.2)
+            if animation.id != id:
+                return
             self.doa()
 
         elif animation.active == LedsService.State.waking_up:
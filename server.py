@@ -4,6 +4,8 @@
 import json
 import time
 import re
+import select
+import socket
 import logging
 import sys
 import argparse
@@ -14,6 +16,8 @@ import paho.mqtt.client as mqtt
 
 from thread_handler import ThreadHandler
 from state_handler import StateHandler, State
+from leds_service import ReSpeakerAnimator
+from frame_stream import MQTT_TOPIC_FRAMES, FrameBuffer, FrameStreamer, FrameReceiver
 
 MQTT_TOPIC_NLU = "hermes/nlu/"
 MQTT_TOPIC_HOTWORD = "hermes/hotword/"
@@ -28,26 +32,77 @@ class Server():
     """ Snips core server. """
     DIALOGUE_EVENT_STARTED, DIALOGUE_EVENT_ENDED, DIALOGUE_EVENT_QUEUED = range(3)
 
+    DEFAULT_SITE_ID = "default"
+
+    class Mode:
+        """ Where the LEDs are driven from.
+
+        local: react on Snips events and drive the local ReSpeaker.
+        central: react on Snips events and stream frames to each site.
+        satellite: apply the frames streamed for this site.
+        """
+        local, central, satellite = range(3)
+
     def __init__(self,
                  mqtt_hostname,
                  mqtt_port,
-                 logger=None):
+                 logger=None,
+                 idle_timeout=None,
+                 idle_color=0,
+                 keepalive=60,
+                 mode=Mode.local,
+                 site_id=DEFAULT_SITE_ID):
         """ Initialisation.
 
         :param config: a YAML configuration.
         :param assistant: the client assistant class, holding the
                           intent handler and intents registry.
+        :param idle_timeout: seconds of inactivity in standby before dimming
+                             the ring, None to never do it.
+        :param idle_color: the colour the ring is dimmed to, 0 to blank it.
+        :param keepalive: MQTT keepalive. The run loop sleeps at most half of
+                          it without any I/O.
+        :param mode: one of Server.Mode.
+        :param site_id: the site whose frames are applied in satellite mode.
         """
         self.logger = logger
+        self.mode = mode
+        self.site_id = site_id
+        self.idle_timeout = idle_timeout
+        self.idle_color = idle_color
         self.thread_handler = ThreadHandler()
-        self.state_handler = StateHandler(self.thread_handler, logger)
+        # Only local mode animates the local LEDs from Snips events. On a
+        # satellite they are driven by the received frames, and a central
+        # ledhandler does not drive its own LEDs.
+        self.state_handler = StateHandler(self.thread_handler, logger,
+                                          idle_timeout=idle_timeout if mode == Server.Mode.local else None,
+                                          idle_color=idle_color,
+                                          detect_leds=mode != Server.Mode.central)
+        self.keepalive = keepalive
+        self.idle_wakeups = 0
+        self.idle_window_start = None
+
+        # Central mode: state handler and frame streamer for each site
+        self.sites = {}
+        self.streamers = {}
+        # Satellite mode: applies the received frames to the local ReSpeaker
+        self.frame_receiver = FrameReceiver(self.state_handler.leds_service.animator, logger,
+                                            idle_after=idle_timeout)
+
+        # Lets other threads wake the run loop up, when publishing or stopping
+        (self.wakeup_r, self.wakeup_w) = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.thread_handler.add_stop_callback(self.wakeup)
 
         self.client = mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
+        self.client.on_publish = self.on_publish
         self.mqtt_hostname = mqtt_hostname
         self.mqtt_port = mqtt_port
+        self.connected = False
 
         self.first_hotword_detected = False
 
@@ -68,29 +123,123 @@ class Server():
         while True and run_event.is_set():
             try:
                 self.log_info("Trying to connect to {}".format(self.mqtt_hostname))
-                self.client.connect(self.mqtt_hostname, self.mqtt_port, 60)
+                self.client.connect(self.mqtt_hostname, self.mqtt_port, self.keepalive)
                 break
             except (socket_error, Exception) as e:
                 self.log_info("MQTT error {}".format(e))
                 time.sleep(5 + int(retry / 5))
                 retry = retry + 1
 
-        topics = [
-            (MQTT_TOPIC_INTENT + '#', 0),
-            (MQTT_TOPIC_HOTWORD + '#', 0),
-            (MQTT_TOPIC_ASR + '#', 0),
-            (MQTT_TOPIC_TTS + '#', 0),
-            (MQTT_TOPIC_NLU + '#', 0)
-        ]
+        if self.mode == Server.Mode.satellite:
+            topics = [(MQTT_TOPIC_FRAMES.format(self.site_id), 0)]
+        else:
+            topics = [
+                (MQTT_TOPIC_INTENT + '#', 0),
+                (MQTT_TOPIC_HOTWORD + '#', 0),
+                (MQTT_TOPIC_ASR + '#', 0),
+                (MQTT_TOPIC_TTS + '#', 0),
+                (MQTT_TOPIC_NLU + '#', 0)
+            ]
         self.log_info("Subscribing to topics {}".format(topics))
         self.client.subscribe(topics)
 
+        self.run_loop(run_event)
+
+    def run_loop(self, run_event):
+        """ Drive the MQTT client from its socket readiness only. The loop
+            wakes up on incoming data, when there is something to write,
+            when another thread calls wakeup(), when an idle deadline is
+            reached, or twice per keepalive period so that the client can
+            ping the broker.
+
+        :param run_event: a run event object provided by the thread handler.
+        """
         while run_event.is_set():
+            sock = self.client.socket()
+            if sock is None:
+                # Disconnected, on_disconnect takes care of reconnecting
+                break
+
+            # The sleep starts from now, not from the last packet sent, so
+            # only sleeping half the keepalive guarantees a timely ping
+            timeout = self.keepalive / 2.0
+            idle_deadlines = [state_handler.idle_deadline for state_handler in self.state_handlers()
+                              if state_handler.idle_deadline is not None]
+            if idle_deadlines:
+                timeout = max(0, min(timeout, min(idle_deadlines) - time.monotonic()))
+
+            wlist = [sock] if self.client.want_write() else []
             try:
-                self.client.loop()
-            except AttributeError as e:
+                readable, writable, _ = select.select([sock, self.wakeup_r], wlist, [], timeout)
+            except (socket_error, ValueError) as e:
                 self.log_info("Error in mqtt run loop {}".format(e))
                 time.sleep(1)
+                continue
+
+            self.count_idle_wakeup()
+
+            if self.wakeup_r in readable:
+                try:
+                    self.wakeup_r.recv(4096)
+                except socket_error:
+                    pass
+            if sock in readable:
+                self.client.loop_read()
+            if sock in writable or self.client.want_write():
+                self.client.loop_write()
+            self.client.loop_misc()
+
+            self.check_idle()
+
+    def wakeup(self):
+        """ Wake the run loop up from another thread. """
+        try:
+            self.wakeup_w.send(b'\0')
+        except socket_error:
+            # Buffer full, the run loop is already due to wake up
+            pass
+
+    def state_handlers(self):
+        if self.mode == Server.Mode.central:
+            return list(self.sites.values())
+        return [self.state_handler]
+
+    def is_idle(self):
+        if self.mode == Server.Mode.satellite:
+            return self.frame_receiver.is_idle()
+        return all(state_handler.is_idle() for state_handler in self.state_handlers())
+
+    def check_idle(self):
+        """ Put the state handlers whose idle deadline has passed to idle. """
+        now = time.monotonic()
+        for state_handler in self.state_handlers():
+            if state_handler.idle_deadline is not None and now >= state_handler.idle_deadline:
+                self.log_info("No activity for {}s, going idle".format(
+                    state_handler.idle_timeout))
+                state_handler.set_state(State.idle)
+
+    def count_idle_wakeup(self):
+        """ Count run loop wakeups while idle, and report them once per
+            minute. The report piggybacks on a wakeup, so it does not add
+            any of its own.
+        """
+        if not self.is_idle():
+            self.idle_window_start = None
+            return
+
+        if self.idle_window_start is None:
+            # Just went idle, start counting from here
+            self.idle_wakeups = 0
+            self.idle_window_start = time.monotonic()
+            return
+
+        self.idle_wakeups = self.idle_wakeups + 1
+        elapsed = time.monotonic() - self.idle_window_start
+        if elapsed >= 60:
+            self.log_info("Idle wakeups per minute: {:.1f}".format(
+                self.idle_wakeups * 60.0 / elapsed))
+            self.idle_wakeups = 0
+            self.idle_window_start = time.monotonic()
 
     # pylint: disable=unused-argument,no-self-use
     def on_connect(self, client, userdata, flags, result_code):
@@ -102,7 +251,14 @@ class Server():
         :param result_code: result code.
         """
         self.log_info("Connected with result code {}".format(result_code))
-        self.state_handler.set_state(State.welcome)
+        self.connected = result_code == 0
+        for streamer in self.streamers.values():
+            streamer.resync()
+        if self.mode == Server.Mode.satellite:
+            # The LEDs belong to the central ledhandler, wait for a keyframe
+            self.frame_receiver.reset()
+        elif self.mode == Server.Mode.local:
+            self.state_handler.set_state(State.welcome)
 
     # pylint: disable=unused-argument
     def on_disconnect(self, client, userdata, result_code):
@@ -114,7 +270,9 @@ class Server():
         :param result_code: result code.
         """
         self.log_info("Disconnected with result code " + str(result_code))
-        self.state_handler.set_state(State.goodbye)
+        self.connected = False
+        if self.mode == Server.Mode.local:
+            self.state_handler.set_state(State.goodbye)
         time.sleep(5)
         self.thread_handler.run(target=self.start_blocking)
 
@@ -129,35 +287,112 @@ class Server():
         if msg is None:
             return
 
+        if self.mode == Server.Mode.satellite:
+            self.frame_receiver.apply(msg.payload)
+            return
+
         self.log_info("New message on topic {}".format(msg.topic))
         self.log_debug("Payload {}".format(msg.payload))
 
         if msg.payload is None or len(msg.payload) == 0:
             pass
 
-        """
-        if msg.payload:
-            payload = json.loads(msg.payload.decode('utf-8'))
-            site_id = payload.get('siteId')
-            session_id = payload.get('sessionId')
-        """
-
+        state = None
         if msg.topic is not None and msg.topic == MQTT_TOPIC_NLU + "intentParsed":
-            self.state_handler.set_state(State.nlu_intent_parsed)
+            state = State.nlu_intent_parsed
         elif msg.topic is not None and msg.topic == MQTT_TOPIC_HOTWORD + "toggleOn":
-            self.state_handler.set_state(State.hotword_toggle_on)
+            state = State.hotword_toggle_on
         elif MQTT_TOPIC_HOTWORD_DETECTED_RE.match(msg.topic):
             if not self.first_hotword_detected:
                 self.client.publish(
                     "hermes/feedback/sound/toggleOff", payload=None, qos=0, retain=False)
                 self.first_hotword_detected = True
-            self.state_handler.set_state(State.hotword_detected)
+            state = State.hotword_detected
         elif msg.topic is not None and msg.topic == MQTT_TOPIC_NLU + "intentNotRecognized":
-            self.state_handler.set_state(State.error)
+            state = State.error
         elif msg.topic is not None and msg.topic.startswith(MQTT_TOPIC_TTS):
-            self.state_handler.set_state(State.say)
+            state = State.say
+
+        if state is None:
+            return
+
+        # Only resolved here, so that messages which do not change any state
+        # do not create a site in central mode
+        state_handler = self.get_state_handler(msg.payload)
+        if state_handler is None:
+            return
+        state_handler.set_state(state)
 
-        self.log_debug("Switching state handler to {}".format(self.state_handler.state))
+        self.log_debug("Switching state handler to {}".format(state_handler.state))
+
+    # pylint: disable=unused-argument
+    def on_publish(self, client, userdata, mid):
+        """ Callback when a message was sent, or acknowledged by the broker
+            for QoS 1 messages.
+
+        :param client: the MQTT client.
+        :param userdata: unused.
+        :param mid: the message id.
+        """
+        for streamer in self.streamers.values():
+            streamer.on_publish(mid)
+
+    def publish(self, topic, payload, qos, retain):
+        """ Publish a message from any thread.
+
+        :return: the MQTT message id, or None if it could not be sent.
+        """
+        if not self.connected:
+            # Paho would queue QoS 1 messages without limit, and flood the
+            # broker with stale frames on reconnection
+            return None
+        (result, mid) = self.client.publish(topic, payload=payload, qos=qos, retain=retain)
+        if result != mqtt.MQTT_ERR_SUCCESS:
+            self.log_debug("Could not publish on {}: {}".format(topic, mqtt.error_string(result)))
+            return None
+        self.wakeup()
+        return mid
+
+    def get_state_handler(self, payload):
+        """ The state handler a Snips message applies to: the local one,
+            or in central mode the one of the message siteId.
+
+        :param payload: the MQTT message payload.
+        :return: the state handler, or None in central mode when the
+                 message has no siteId.
+        """
+        if self.mode != Server.Mode.central:
+            return self.state_handler
+
+        site_id = None
+        try:
+            site_id = json.loads(payload.decode('utf-8')).get('siteId')
+        except (ValueError, AttributeError):
+            pass
+        if not site_id:
+            self.log_debug("No siteId in message, ignoring it")
+            return None
+        return self.get_site(site_id)
+
+    def get_site(self, site_id):
+        """ The state handler of a site, rendering into a frame buffer
+            that is streamed to the site satellite.
+
+        :param site_id: the site id.
+        """
+        if site_id not in self.sites:
+            self.log_info("Streaming frames to site {}".format(site_id))
+            frame_buffer = FrameBuffer()
+            animator = ReSpeakerAnimator(logger=self.logger, hid=frame_buffer)
+            streamer = FrameStreamer(site_id, frame_buffer, self.publish, self.logger)
+            self.sites[site_id] = StateHandler(self.thread_handler, self.logger,
+                                               idle_timeout=self.idle_timeout,
+                                               idle_color=self.idle_color,
+                                               animator=animator)
+            self.streamers[site_id] = streamer
+            self.thread_handler.add_stop_callback(streamer.stop)
+            self.thread_handler.run(target=streamer.run)
+        return self.sites[site_id]
 
     def log_info(self, message):
         if self.logger is not None:
@@ -171,7 +406,7 @@ class Server():
         if self.logger is not None:
             self.logger.error(message)
 
-def main_start():
+def main_start(idle_timeout=None, idle_color=0, mode=Server.Mode.local, site_id=Server.DEFAULT_SITE_ID):
     # define logging parameters
     logger = logging.getLogger(__name__)
     print (logger)
@@ -184,7 +419,9 @@ def main_start():
     logger.setLevel(logging.DEBUG)
 
     # start the handler
-    led_handler = Server("localhost", 1883, logger = logger)
+    led_handler = Server("localhost", 1883, logger = logger,
+                         idle_timeout = idle_timeout, idle_color = idle_color,
+                         mode = mode, site_id = site_id)
     led_handler.start()
     #led_hanlder.state_handler.set_state(State.welcome)
 
@@ -206,12 +443,22 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="LED handler for ReSpeaker used with Snips")
     parser.add_argument('action', type=str, choices=['start', 'list', 'try'], help="Action to launch in the LED handler")
     parser.add_argument('--state', help="The state you wish to try")
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help="Seconds of inactivity in standby before dimming the LEDs (default: never). "
+                             "On a satellite, seconds without frames before it counts as idle (default: 10)")
+    parser.add_argument('--idle-color', type=lambda value: int(value, 16), default=0,
+                        help="Hex RGB colour the LEDs are dimmed to when idle (default: 000000, off)")
+    parser.add_argument('--mode', choices=['local', 'central', 'satellite'], default='local',
+                        help="Drive the local LEDs, stream frames to satellites, or apply streamed frames (default: local)")
+    parser.add_argument('--site-id', default=Server.DEFAULT_SITE_ID,
+                        help="The site whose frames are applied in satellite mode (default: default)")
     args = parser.parse_args(sys.argv[1:])
 
     if (args.action == 'list'):
         main_list()
     elif (args.action == 'start'):
-        main_start()
+        main_start(args.idle_timeout, args.idle_color,
+                   getattr(Server.Mode, args.mode), args.site_id)
     elif (args.action == 'try'):
         main_try(args.state)
 
@@ -17,19 +17,49 @@ class State:
 class StateHandler:
     """ Handler for various states of the system. """
 
-    def __init__(self, thread_handler, logger = None):
-        self.leds_service = LedsService(thread_handler, logger)
+    def __init__(self, thread_handler, logger = None, idle_timeout = None, idle_color = 0, animator = None,
+                 detect_leds = True):
+        """ Initialisation.
+
+        :param thread_handler: the thread handler running the animations.
+        :param logger: optional logger.
+        :param idle_timeout: seconds of inactivity in standby before going
+                             idle, None to never go idle.
+        :param idle_color: the colour the ring is dimmed to when idle, 0 to
+                           switch it off.
+        :param animator: the animator to drive, instead of the local
+                         ReSpeaker.
+        :param detect_leds: whether to look for a local ReSpeaker when no
+                            animator is given.
+        """
+        self.leds_service = LedsService(thread_handler, logger, animator, detect_leds)
         self.state = None
+        self.idle_timeout = idle_timeout
+        self.idle_color = idle_color
+        self.idle_deadline = None
+
+    def is_idle(self):
+        return self.state == State.idle
+
+    def arm_idle(self):
+        """ Start counting inactivity from now on. """
+        if self.idle_timeout:
+            self.idle_deadline = time.monotonic() + self.idle_timeout
 
     def set_state(self, state):
+        self.idle_deadline = None
         if state == State.goodbye:
             self.leds_service.start_animation(LedsService.State.none)
         elif state == State.welcome:
             self.leds_service.start_animation(LedsService.State.waking_up)
             time.sleep(2.2)
             self.leds_service.start_animation(LedsService.State.standby)
+            self.arm_idle()
         elif state == State.hotword_toggle_on:
             self.leds_service.start_animation(LedsService.State.standby)
+            self.arm_idle()
+        elif state == State.idle:
+            self.leds_service.idle(self.idle_color)
         elif state == State.hotword_detected:
             self.leds_service.start_animation(LedsService.State.listening)
         elif state == State.nlu_intent_parsed:
@@ -2,7 +2,6 @@
 """ Thread handler. """
 
 import threading
-import time
 
 from singleton import Singleton
 from usb_utils import USB
@@ -15,6 +14,8 @@ class ThreadHandler(Singleton):
         """ Initialisation. """
         self.thread_pool = []
         self.run_events = []
+        self.stop_event = threading.Event()
+        self.stop_callbacks = []
 
     def run(self, target, args=()):
         """ Run a function in a separate thread.
@@ -22,6 +23,7 @@ class ThreadHandler(Singleton):
         :param target: the function to run.
         :param args: the parameters to pass to the function.
         """
+        self.prune()
         run_event = threading.Event()
         run_event.set()
         thread = threading.Thread(target=target, args=args + (run_event, ))
@@ -29,16 +31,34 @@ class ThreadHandler(Singleton):
         self.run_events.append(run_event)
         thread.start()
 
+    def add_stop_callback(self, callback):
+        """ Register a function called on stop, after the run events are
+            cleared, to wake up a thread blocked without timeout.
+
+        :param callback: the function to call, without arguments.
+        """
+        self.stop_callbacks.append(callback)
+
+    def prune(self):
+        """ Forget about threads that have finished, along with their
+            run events, so that short-lived animations do not pile up.
+        """
+        alive = [(thread, run_event) for (thread, run_event)
+                 in zip(self.thread_pool, self.run_events) if thread.is_alive()]
+        self.thread_pool = [thread for (thread, _) in alive]
+        self.run_events = [run_event for (_, run_event) in alive]
+
     def start_run_loop(self, logger=None):
         """ Start the thread handler, ensuring that everything stops property
-            when sending a keyboard interrup.
+            when sending a keyboard interrup. The main thread blocks on an
+            event without any timeout, so it never wakes up by itself.
         """
         try:
             if logger is not None:
                 logger.debug("Starting run loop thread")
 
-                while 1:
-                    time.sleep(.1)
+            while not self.stop_event.wait():
+                pass
         except KeyboardInterrupt:
             if logger is not None:
                 logger.debug("Exiting run loop thread on KeyboardInterrupt")
@@ -46,8 +66,12 @@ class ThreadHandler(Singleton):
 
     def stop(self):
         """ Stop all functions running in the thread handler."""
+        self.stop_event.set()
         for run_event in self.run_events:
             run_event.clear()
 
+        for callback in self.stop_callbacks:
+            callback()
+
         for thread in self.thread_pool:
             thread.join()